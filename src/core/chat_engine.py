@@ -2,17 +2,33 @@
 Query engine and response synthesis for the Chat with Docs application.
 """
 
+import re
+import asyncio
+import inspect
+import logging
+import functools
 import streamlit as st
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional
 
 from llama_index.core import PromptTemplate
 from llama_index.core.response_synthesizers import ResponseMode, get_response_synthesizer
 from llama_index.core.query_engine import RetrieverQueryEngine
 
 from ..utils.logger import Logger
-from ..utils.image import process_source_for_images, get_document_images
+from ..utils.image import process_source_for_images, get_document_images, get_document_image_index
 from ..config import CITATION_PROMPT
 
+# Matches citation markers like [1], [2] in synthesized answers
+_CITATION_RE = re.compile(r"\[(\d+)\]")
+
+
+@functools.lru_cache(maxsize=1)
+def _get_citation_prompt_template():
+    """Build the citation prompt template once and share it across query engines."""
+    # Use citation prompt (now the default)
+    return PromptTemplate(CITATION_PROMPT)
+
+
 class ChatEngine:
     """Manages query processing and response generation."""
     
@@ -43,16 +59,10 @@ class ChatEngine:
             mode="OR",
         )
         
-        # Use citation prompt (now the default)
-        prompt_template_str = CITATION_PROMPT
-        
-        # Convert string template to PromptTemplate
-        prompt_template = PromptTemplate(prompt_template_str)
-        
-        # Create response synthesizer
+        # Create response synthesizer (one per engine, since the LLM is set on it at query time)
         response_synthesizer = get_response_synthesizer(
             response_mode=ResponseMode.COMPACT,
-            text_qa_template=prompt_template
+            text_qa_template=_get_citation_prompt_template()
             # LLM will be updated at query time, no need to set it here
         )
         
@@ -81,6 +91,105 @@ class ChatEngine:
         Returns:
             Dictionary containing answer, sources, and images
         """
+        error_response = ChatEngine._ensure_query_engine(file_name)
+        if error_response is not None:
+            return error_response
+        
+        Logger.info(f"Processing query for document {file_name}: {prompt[:50]}...")
+        
+        try:
+            query_engine = ChatEngine._prepare_query_engine(file_name)
+            
+            # Execute query
+            response = query_engine.query(prompt)
+            
+            return ChatEngine._process_response(prompt, file_name, response)
+        
+        except Exception as e:
+            Logger.error(f"Error processing query: {str(e)}")
+            return {
+                'answer': f"Error processing your query: {str(e)}",
+                'sources': [],
+                'images': []
+            }
+    
+    @staticmethod
+    def process_queries_batch(prompt: str, file_names: List[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        Process a query against several documents, running the queries concurrently.
+        
+        Args:
+            prompt: The user query
+            file_names: The names of the files to query
+            
+        Returns:
+            Dictionary mapping each file name to its result, as returned by process_query
+        """
+        results = {}
+        query_engines = {}
+        
+        for file_name in file_names:
+            error_response = ChatEngine._ensure_query_engine(file_name)
+            if error_response is not None:
+                results[file_name] = error_response
+                continue
+            
+            Logger.info(f"Processing query for document {file_name}: {prompt[:50]}...")
+            try:
+                query_engines[file_name] = ChatEngine._prepare_query_engine(file_name)
+            except Exception as e:
+                Logger.error(f"Error processing query: {str(e)}")
+                results[file_name] = {
+                    'answer': f"Error processing your query: {str(e)}",
+                    'sources': [],
+                    'images': []
+                }
+        
+        async def _aquery_one(query_engine):
+            # Fall back to a synchronous query if the engine has no async path
+            aquery = getattr(query_engine, 'aquery', None)
+            if aquery is None:
+                return query_engine.query(prompt)
+            response = aquery(prompt)
+            if inspect.isawaitable(response):
+                response = await response
+            return response
+        
+        async def _aquery_all():
+            return await asyncio.gather(
+                *[_aquery_one(query_engine) for query_engine in query_engines.values()],
+                return_exceptions=True
+            )
+        
+        # Execute all queries concurrently
+        responses = asyncio.run(_aquery_all()) if query_engines else []
+        
+        for file_name, response in zip(query_engines, responses):
+            try:
+                if isinstance(response, Exception):
+                    raise response
+                results[file_name] = ChatEngine._process_response(prompt, file_name, response)
+            except Exception as e:
+                Logger.error(f"Error processing query for document {file_name}: {str(e)}")
+                results[file_name] = {
+                    'answer': f"Error processing your query: {str(e)}",
+                    'sources': [],
+                    'images': []
+                }
+        
+        return {file_name: results[file_name] for file_name in file_names}
+    
+    @staticmethod
+    def _ensure_query_engine(file_name: str) -> Optional[Dict[str, Any]]:
+        """
+        Make sure a query engine exists for a file, re-creating it if possible.
+        
+        Args:
+            file_name: The name of the file to query
+            
+        Returns:
+            None if the query engine is available, otherwise an error response dictionary
+        """
         # Check if file_name exists in the session state
         if file_name not in st.session_state.query_engine:
             Logger.warning(f"Query engine not found for file: {file_name}. Attempting to re-create it.")
@@ -113,41 +222,58 @@ class ChatEngine:
                     'images': []
                 }
         
-        Logger.info(f"Processing query for document {file_name}: {prompt[:50]}...")
+        return None
+    
+    @staticmethod
+    def _prepare_query_engine(file_name: str):
+        """
+        Get the query engine for a file, updated to use the current LLM.
         
-        try:
-            # Log which model is being used just before executing the query
-            from llama_index.core import Settings
-            current_model = getattr(Settings.llm, 'model', 'unknown') if hasattr(Settings.llm, 'model') else str(Settings.llm)
-            Logger.info(f"Executing query with model: {current_model}")
-            
-            # Get the query engine
-            query_engine = st.session_state.query_engine[file_name]
-            
-            # Ensure the query engine is using the current LLM
-            from llama_index.core import Settings
-            if hasattr(query_engine._response_synthesizer, "_llm"):
-                # Set the LLM directly on the response synthesizer to ensure it's using the latest
-                query_engine._response_synthesizer._llm = Settings.llm
-                Logger.info(f"Using model: {getattr(Settings.llm, 'model', str(Settings.llm))} for this query")
-            
-            # Execute query
-            response = query_engine.query(prompt)
+        Args:
+            file_name: The name of the file to query
             
-            # Get the answer text
-            if hasattr(response, 'response'):
-                synthesized_answer = response.response
-            else:
-                synthesized_answer = str(response)
+        Returns:
+            Object: Query engine for the document
+        """
+        # Log which model is being used just before executing the query
+        from llama_index.core import Settings
+        current_model = getattr(Settings.llm, 'model', 'unknown') if hasattr(Settings.llm, 'model') else str(Settings.llm)
+        Logger.info(f"Executing query with model: {current_model}")
+        
+        # Get the query engine
+        query_engine = st.session_state.query_engine[file_name]
+        
+        # Ensure the query engine is using the current LLM
+        from llama_index.core import Settings
+        if hasattr(query_engine._response_synthesizer, "_llm"):
+            # Set the LLM directly on the response synthesizer to ensure it's using the latest
+            query_engine._response_synthesizer._llm = Settings.llm
+            Logger.info(f"Using model: {getattr(Settings.llm, 'model', str(Settings.llm))} for this query")
+        
+        return query_engine
+    
+    @staticmethod
+    def _process_response(prompt: str, file_name: str, response) -> Dict[str, Any]:
+        """
+        Renumber citations, extract images, and store the response for a query.
+        
+        Args:
+            prompt: The user query
+            file_name: The name of the queried file
+            response: Response returned by the query engine
             
-            # Get source nodes if available
-            source_nodes = []
-            if hasattr(response, 'source_nodes'):
-                source_nodes = response.source_nodes
-            elif 'source_nodes' in dir(response):
-                source_nodes = response.source_nodes
+        Returns:
+            Dictionary containing answer, sources, images, and citation mapping
+        """
+        # Get the answer text
+        synthesized_answer = getattr(response, 'response', None) or str(response)
+        
+        # Get source nodes if available
+        source_nodes = getattr(response, 'source_nodes', None) or []
 
-            # DEBUG: Log full retrieved source node text
+        # DEBUG: Log retrieved source nodes (skipped when the previews would be discarded)
+        if Logger.is_enabled_for(logging.INFO):
+            # Log full retrieved source node text
             for idx, src in enumerate(source_nodes):
                 try:
                     full_text = getattr(src, 'text', '')
@@ -155,8 +281,7 @@ class ChatEngine:
                 except Exception as e:
                     Logger.warning(f"Error logging retrieved source text: {e}")
 
-
-            # DEBUG: Log retrieved source nodes
+            # Log retrieved source pages and previews
             for idx, src in enumerate(source_nodes):
                 meta = getattr(src, 'metadata', {})
                 page = meta.get('page') if isinstance(meta, dict) else None
@@ -164,85 +289,59 @@ class ChatEngine:
                 Logger.info(f"Retrieved source {idx}: page {page}, length {len(text)}, preview: {text[:200].replace('\n', ' ')}")
 
 
-            # --- Citation renumbering ---
-            from ..utils.source import extract_citation_indices
-            import re
-
-            # Extract all citation indices from the answer text
-            original_citation_indices = extract_citation_indices(synthesized_answer)
+        # --- Citation renumbering ---
+        # Renumber citations sequentially in a single pass over the answer text,
+        # mapping original citation numbers to new numbers in order of first appearance
+        citation_map = {}
 
-            # Create mapping from original citation numbers to new sequential numbers
-            citation_map = {}
-            for idx in original_citation_indices:
-                if idx not in citation_map:
-                    citation_map[idx] = len(citation_map) + 1  # assign next sequential number
+        def replace_citation(match):
+            orig_num = int(match.group(1))
+            new_num = citation_map.get(orig_num)
+            if new_num is None:
+                new_num = len(citation_map) + 1  # assign next sequential number
+                citation_map[orig_num] = new_num
+            return f"[{new_num}]"
 
-            # Build reverse map: new citation number -> original source node index (0-based)
-            reverse_citation_map = {}
-            for orig_citation_num, new_citation_num in citation_map.items():
-                # orig_citation_num is 1-based original citation number (== source node index +1)
-                # new_citation_num is 1-based new citation number
-                reverse_citation_map[new_citation_num] = orig_citation_num - 1  # convert to 0-based index
+        synthesized_answer = _CITATION_RE.sub(replace_citation, synthesized_answer)
 
-            # Replace all citation markers in the answer text
-            def replace_citation(match):
-                orig_num = int(match.group(1))
-                new_num = citation_map.get(orig_num, orig_num)
-                return f"[{new_num}]"
+        # Build reverse map: new citation number -> original source node index (0-based)
+        reverse_citation_map = {}
+        for orig_citation_num, new_citation_num in citation_map.items():
+            # orig_citation_num is 1-based original citation number (== source node index +1)
+            # new_citation_num is 1-based new citation number
+            reverse_citation_map[new_citation_num] = orig_citation_num - 1  # convert to 0-based index
+        # --- End citation renumbering ---
 
-            synthesized_answer = re.sub(r"\[(\d+)\]", replace_citation, synthesized_answer)
-            # --- End citation renumbering ---
-            
-            # Map new citation numbers back to original indices for filtering
-            renumbered_citations = extract_citation_indices(synthesized_answer)
-            # Convert new citation numbers to original 0-based source node indices
-            original_citations_for_filtering = [reverse_citation_map.get(c, c) for c in renumbered_citations]
+        # Original 0-based source node indices of the cited sources, in citation order
+        original_citations_for_filtering = [orig_num - 1 for orig_num in citation_map]
 
-            # Store response for future reference
-            if 'document_responses' not in st.session_state:
-                st.session_state['document_responses'] = {}
-            if file_name not in st.session_state['document_responses']:
-                st.session_state['document_responses'][file_name] = {}
-            
-            # Look for image references in relevant text nodes BEFORE storing the response
-            images = ChatEngine._extract_images_from_sources(source_nodes, file_name, original_citations_for_filtering)
-            
-            # Store this response with its sources AND images
-            st.session_state['document_responses'][file_name] = {
-                'last_query': prompt,
-                'last_response': synthesized_answer,
-                'answer': synthesized_answer,  # Add 'answer' key for compatibility
-                'sources': source_nodes,
-                'images': images  # Add images to the stored response
-            }
-            
-            # Convert citation mapping keys to strings and strip whitespace for consistent UI lookup
-            reverse_citation_map = {str(k).strip(): v for k, v in reverse_citation_map.items()}
+        # Store response for future reference
+        if 'document_responses' not in st.session_state:
+            st.session_state['document_responses'] = {}
+        
+        # Look for image references in relevant text nodes BEFORE storing the response
+        images = ChatEngine._extract_images_from_sources(source_nodes, file_name, original_citations_for_filtering)
+        
+        # Convert citation mapping keys to strings and strip whitespace for consistent UI lookup
+        reverse_citation_map = {str(k).strip(): v for k, v in reverse_citation_map.items()}
 
-            # Store this response with its sources, images, and normalized citation mapping
-            st.session_state['document_responses'][file_name] = {
-                'last_query': prompt,
-                'last_response': synthesized_answer,
-                'answer': synthesized_answer,
-                'sources': source_nodes,
-                'images': images,
-                'citation_mapping': reverse_citation_map  # Store normalized mapping
-            }
+        # Store this response with its sources, images, and normalized citation mapping
+        st.session_state['document_responses'][file_name] = {
+            'last_query': prompt,
+            'last_response': synthesized_answer,
+            'answer': synthesized_answer,  # Add 'answer' key for compatibility
+            'sources': source_nodes,
+            'images': images,
+            'citation_map': citation_map,  # Original citation number -> new citation number
+            'citation_mapping': reverse_citation_map  # Store normalized mapping
+        }
 
-            return {
-                'answer': synthesized_answer,
-                'sources': source_nodes,
-                'images': images,
-                'citation_mapping': reverse_citation_map  # Use string keys
-            }
-        
-        except Exception as e:
-            Logger.error(f"Error processing query: {str(e)}")
-            return {
-                'answer': f"Error processing your query: {str(e)}",
-                'sources': [],
-                'images': []
-            }
+        return {
+            'answer': synthesized_answer,
+            'sources': source_nodes,
+            'images': images,
+            'citation_mapping': reverse_citation_map  # Use string keys
+        }
     
     @staticmethod
     def _extract_images_from_sources(source_nodes, file_name, citation_indices=None):
@@ -273,6 +372,13 @@ class ChatEngine:
         available_images = get_document_images(doc_id)
         Logger.info(f"Found {len(available_images)} available images for document {doc_id}")
         
+        # Documents without images can't yield any, so skip scanning the sources
+        if not available_images:
+            Logger.info(f"No images available for document {doc_id}; skipping image extraction")
+            return images
+        
+        image_index = get_document_image_index(doc_id)
+        
         # Determine which sources are actually cited in the response
         cited_sources = []
         cited_indices = []
@@ -282,13 +388,18 @@ class ChatEngine:
             cited_indices = citation_indices
             Logger.info(f"Using original citation indices passed from process_query: {cited_indices}")
         else:
-            # Fallback: extract from current answer text (may be renumbered, less accurate)
+            # Fallback: reuse the citation map stored with the last response
             if file_name in st.session_state.get('document_responses', {}):
                 last_response = st.session_state['document_responses'][file_name]
-                answer_text = last_response.get('answer', '')
-                from ..utils.source import extract_citation_indices
-                cited_indices = extract_citation_indices(answer_text)
-                Logger.info(f"Extracted citation indices from answer text: {cited_indices}")
+                citation_map = last_response.get('citation_map')
+                if citation_map is not None:
+                    cited_indices = [orig_num - 1 for orig_num in citation_map]
+                    Logger.info(f"Using citation indices from stored citation map: {cited_indices}")
+                else:
+                    # Older responses without a citation map: extract from the (renumbered) answer text
+                    answer_text = last_response.get('answer', '')
+                    cited_indices = [int(x) for x in _CITATION_RE.findall(answer_text)]
+                    Logger.info(f"Extracted citation indices from answer text: {cited_indices}")
         
         # Map the citations to source indices (0-based)
         for idx in cited_indices:
@@ -312,49 +423,36 @@ class ChatEngine:
             Logger.info("No cited sources with images found; returning no images")
             return images
 
+        # Collect images keyed by file path so duplicates across sources are dropped on insert
+        images_by_path: Dict[str, Dict[str, Any]] = {}
+
         # Process only the cited sources for images
+        log_previews = Logger.is_enabled_for(logging.INFO)
         for i, source in enumerate(sources_to_process):
-            try:
-                # DEBUG: Log cited source content before image extraction
-                meta = getattr(source, 'metadata', {})
+            if log_previews:
+                try:
+                    # DEBUG: Log cited source content before image extraction
+                    meta = getattr(source, 'metadata', {})
 
-                # DEBUG: Log images metadata of this cited source
-                images_meta_str = meta.get('images', '') if isinstance(meta, dict) else ''
-                Logger.info(f"Cited source images metadata: {images_meta_str[:500]}")
+                    # DEBUG: Log images metadata of this cited source
+                    images_meta_str = meta.get('images', '') if isinstance(meta, dict) else ''
+                    Logger.info(f"Cited source images metadata: {images_meta_str[:500]}")
 
-                page = meta.get('page') if isinstance(meta, dict) else None
-                text = getattr(source, 'text', '')
-                Logger.info(f"Processing cited source page {page}, preview: {text[:200].replace('\\n', ' ')}")
-            except Exception as e:
-                Logger.warning(f"Error logging cited source: {e}")
+                    page = meta.get('page') if isinstance(meta, dict) else None
+                    text = getattr(source, 'text', '')
+                    Logger.info(f"Processing cited source page {page}, preview: {text[:200].replace('\\n', ' ')}")
+                except Exception as e:
+                    Logger.warning(f"Error logging cited source: {e}")
             Logger.debug(f"Processing cited source {i+1}/{len(sources_to_process)} for images")
             
-            # Only use pattern matches from available images, no fallbacks
-            source_images = process_source_for_images(source, doc_id, available_images)
-
-            # Also parse images from metadata
-            meta = getattr(source, 'metadata', {})
-            try:
-                import json
-                image_meta_list = json.loads(meta.get('images', '[]')) if isinstance(meta, dict) else []
-                for img_meta in image_meta_list:
-                    img_path = img_meta.get('file_path') or img_meta.get('path')
-                    caption = img_meta.get('caption', '')
-                    if img_path and not any(img.get('file_path') == img_path for img in images):
-                        images.append({
-                            'file_path': img_path,
-                            'caption': '' if caption.strip() == '-----' else caption,
-                            'page': meta.get('page') if isinstance(meta, dict) else None
-                        })
-                        Logger.debug(f"Added image from metadata: {img_path}")
-            except Exception as e:
-                Logger.warning(f"Error parsing images metadata: {e}")
+            # Images from the source metadata and Markdown references to available images
+            # (only use pattern matches from available images, no fallbacks)
+            source_images = process_source_for_images(source, doc_id, image_index)
 
-            # Add all images found for this source (avoiding duplicates)
+            # Add all images found for this source (keeping the first occurrence of each path)
             for img_info in source_images:
-                if not any(img.get('file_path') == img_info.get('file_path') for img in images):
-                    images.append(img_info)
-                    Logger.debug(f"Added image: {img_info.get('file_path')}")
+                images_by_path.setdefault(img_info.get('file_path'), img_info)
         
+        images = list(images_by_path.values())
         Logger.info(f"Found {len(images)} images in source nodes")
         return images
\ No newline at end of file
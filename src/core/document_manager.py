@@ -95,6 +95,9 @@ class DocumentManager:
                 'doc_id': doc_id,
                 'invalid': False
             }
+            
+            # Cache page count so the UI doesn't reopen the PDF on every rerun
+            pdf_data['page_count'] = FileProcessor.get_pdf_page_count(pdf_path)
             StateManager.store_pdf_data(file_name, pdf_data)
             
             # Store binary data for reliable access
@@ -88,6 +88,24 @@ class FileProcessor:
             Logger.error(f"Error reading file {file_path}: {e}")
             return None
     
+    @staticmethod
+    def get_pdf_page_count(file_path: str) -> Optional[int]:
+        """Read the page count of a PDF file.
+        
+        Args:
+            file_path: Path to the PDF file
+            
+        Returns:
+            int: Number of pages, or None if the file can't be read
+        """
+        try:
+            import fitz  # PyMuPDF
+            with fitz.open(file_path) as doc:
+                return doc.page_count
+        except Exception as e:
+            Logger.warning(f"Could not determine page count of {file_path}: {e}")
+            return None
+    
     @staticmethod
     def verify_file_exists(file_path: str) -> bool:
         """Check if a file exists and is accessible.
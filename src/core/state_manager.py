@@ -178,6 +178,11 @@ class StateManager:
         if 'document_image_map' not in st.session_state:
             st.session_state['document_image_map'] = {}
         st.session_state['document_image_map'][doc_id] = image_paths
+        # Invalidate the cached image validation results for this document
+        st.session_state.get('_img_index', {}).pop(doc_id, None)
+        valid_images_cache = st.session_state.get('_valid_images', {})
+        for key in [k for k in valid_images_cache if k[0] == doc_id]:
+            del valid_images_cache[key]
     
     @staticmethod
     def get_document_image_map(doc_id: str) -> List[str]:
@@ -3,11 +3,22 @@ Reusable UI components for the Chat with Docs application.
 """
 
 import os
+import re
 import streamlit as st
 import ast
-import fitz  # PyMuPDF
 
 from ..utils.logger import Logger
+from ..core.file_processor import FileProcessor
+
+# Matches the page number in extracted image file names (format: filename-page-index.jpg)
+_PAGE_RE = re.compile(r"-(\d+)-\d+\.[A-Za-z]+$")
+
+
+@st.cache_data(show_spinner=False)
+def _get_pdf_page_count(pdf_path: str, mtime: float):
+    """Get the page count of a PDF, cached per path and modification time."""
+    return FileProcessor.get_pdf_page_count(pdf_path)
+
 
 def display_document_info(file_name: str) -> None:
     """Display metadata information for the current document."""
@@ -29,7 +40,7 @@ def display_document_info(file_name: str) -> None:
     
     # Get a representative node to extract metadata
     try:
-        metadata = _extract_document_metadata(vector_index)
+        metadata = _extract_document_metadata(vector_index, doc_id)
         if not metadata:
             raise ValueError("Could not extract metadata")
     except Exception as e:
@@ -58,27 +69,25 @@ def display_document_info(file_name: str) -> None:
         st.markdown(f"{summary}")
         st.markdown("---")
     
-    # Page count - get from the PDF path if available
+    # Page count - cached when the document was processed, else read from the PDF path
+    page_count = st.session_state.pdf_data[file_name].get('page_count')
     pdf_path = st.session_state.pdf_data[file_name].get('path')
-    if pdf_path and os.path.exists(pdf_path):
-        try:
-            doc = fitz.open(pdf_path)
-            st.markdown(f"**Page count:** {len(doc)}")
-            doc.close()
-        except Exception as e:
-            Logger.warning(f"Could not determine page count: {str(e)}")
+    if page_count is None and pdf_path and os.path.exists(pdf_path):
+        page_count = _get_pdf_page_count(pdf_path, os.path.getmtime(pdf_path))
+        st.session_state.pdf_data[file_name]['page_count'] = page_count
+    if page_count is not None:
+        st.markdown(f"**Page count:** {page_count}")
     
     # Table of Contents
     if metadata.get('toc_items') and metadata['toc_items'] not in ['None', 'null', '[]']:
         st.markdown("**Table of Contents:**")
-        try:
-            # Safely evaluate the toc_items string
-            toc_items = ast.literal_eval(metadata['toc_items'])
-            if isinstance(toc_items, list) and toc_items:
-                for item in toc_items:
-                    if isinstance(item, dict) and 'title' in item and 'page' in item:
-                        st.markdown(f"- {item['title']} (Page {item['page']})")
-        except Exception as e:
+        # Use the TOC parsed when the metadata was extracted
+        toc_items = metadata.get('_toc_parsed')
+        if isinstance(toc_items, list):
+            for item in toc_items:
+                if isinstance(item, dict) and 'title' in item and 'page' in item:
+                    st.markdown(f"- {item['title']} (Page {item['page']})")
+        else:
             # Fallback to displaying the raw string
             st.markdown(metadata['toc_items'])
 
@@ -123,8 +132,7 @@ def display_document_images(file_name: str, container_height: int = None) -> Non
             # Display images in a grid with captions
             displayed_count = 0
             for i, img_info in enumerate(unified_images):
-                # Try both 'file_path' and 'path' for backward compatibility
-                img_path = img_info.get('file_path') or img_info.get('path')
+                img_path = img_info.get('file_path')
                 if not img_path:
                     Logger.warning(f"Image {i+1} has no path: {img_info}")
                     continue
@@ -135,10 +143,6 @@ def display_document_images(file_name: str, container_height: int = None) -> Non
                 # Check if image exists
                 if os.path.exists(img_path):
                     try:
-                        # Read the image file as binary data
-                        with open(img_path, 'rb') as f:
-                            img_bytes = f.read()
-
                         # Get page number and caption
                         page_num = img_info.get('page', 'Unknown')
                         caption = img_info.get('caption', '')
@@ -149,7 +153,8 @@ def display_document_images(file_name: str, container_height: int = None) -> Non
                                 display_caption = f"Page {page_num}: {caption}"
                             else:
                                 display_caption = f"Page {page_num}"
-                            st.image(img_bytes, caption=display_caption)
+                            # Let Streamlit load the image from its path
+                            st.image(img_path, caption=display_caption)
                             st.caption(f"Image {displayed_count+1} of {len(unified_images)}")
 
                         displayed_count += 1
@@ -187,24 +192,18 @@ def display_document_images(file_name: str, container_height: int = None) -> Non
         # Check if image exists
         if os.path.exists(img_path):
             # Extract page number from filename (format: filename-page-index.jpg)
-            page_num = "Unknown"
-            try:
-                # Pattern is usually: filename-page-index.jpg
-                parts = os.path.basename(img_path).split('-')
-                if len(parts) >= 2:
-                    page_part = parts[-2]
-                    page_num = int(page_part)  # No need to add 1, metadata now has correct page numbers
-            except Exception as e:
-                Logger.warning(f"Could not extract page number from {img_path}: {e}")
+            # No need to add 1, metadata now has correct page numbers
+            match = _PAGE_RE.search(img_path)
+            if match:
+                page_num = int(match.group(1))
+            else:
+                page_num = "Unknown"
+                Logger.debug(f"Could not extract page number from {img_path}")
             
             try:
-                # Read the image file as binary data
-                with open(img_path, 'rb') as f:
-                    img_bytes = f.read()
-                
-                # Display image in the appropriate column using binary data
+                # Display image in the appropriate column, loaded from its path by Streamlit
                 with cols[i % 3]:
-                    st.image(img_bytes, caption=f"Page {page_num}")
+                    st.image(img_path, caption=f"Page {page_num}")
                     st.caption(f"Image {i+1} of {len(image_paths)}")
             except Exception as e:
                 with cols[i % 3]:
@@ -216,15 +215,25 @@ def display_document_images(file_name: str, container_height: int = None) -> Non
                 st.warning(f"Image file not found: {os.path.basename(img_path)}")
 
 
-def _extract_document_metadata(vector_index):
+def _extract_document_metadata(vector_index, doc_id):
     """Helper function to extract metadata from a vector index.
     
+    The result is cached in session state per document, since it doesn't change
+    for a given index.
+    
     Args:
         vector_index: The vector index containing document metadata
+        doc_id: The document ID, used as the cache key
         
     Returns:
         dict: Document metadata or None if not found
     """
+    meta_cache = st.session_state.setdefault('_doc_meta', {})
+    if doc_id in meta_cache:
+        return meta_cache[doc_id]
+    
+    metadata = None
+    
     # Extract based on docstore API structure
     try:
         # Try to get documents using the docstore API
@@ -232,32 +241,39 @@ def _extract_document_metadata(vector_index):
         if hasattr(vector_index.docstore, 'get_all'):
             all_documents = vector_index.docstore.get_all()
             if all_documents:
-                first_node_id = list(all_documents.keys())[0]
-                first_node = all_documents[first_node_id]
-                return first_node.metadata
+                metadata = next(iter(all_documents.values())).metadata
             
         # Second attempt: for newer versions with docs dictionary
         elif hasattr(vector_index.docstore, 'docs'):
             if vector_index.docstore.docs:
-                first_node_id = list(vector_index.docstore.docs.keys())[0]
-                first_node = vector_index.docstore.docs[first_node_id]
-                return first_node.metadata
+                metadata = next(iter(vector_index.docstore.docs.values())).metadata
             
         # Third attempt: get document IDs and fetch first document
         elif hasattr(vector_index.docstore, 'get_document_ids'):
             doc_ids = vector_index.docstore.get_document_ids()
             if doc_ids:
-                first_node_id = doc_ids[0]
-                first_node = vector_index.docstore.get_document(first_node_id)
-                return first_node.metadata
+                first_node = vector_index.docstore.get_document(doc_ids[0])
+                metadata = first_node.metadata
             
         # Fallback method - try to get documents from the index
         elif hasattr(vector_index, 'ref_docs'):
             ref_docs = vector_index.ref_docs
             if ref_docs:
-                first_node = list(ref_docs.values())[0]
-                return first_node.metadata
+                metadata = next(iter(ref_docs.values())).metadata
     except Exception as e:
         Logger.error(f"Error extracting metadata: {str(e)}")
     
-    return None
\ No newline at end of file
+    if metadata is not None:
+        # Work on a copy so the parsed TOC doesn't leak into the node's metadata
+        metadata = dict(metadata)
+        
+        # Parse the stringified toc_items once instead of on every render
+        toc_items = metadata.get('toc_items')
+        if isinstance(toc_items, str) and toc_items not in ['None', 'null', '[]']:
+            try:
+                metadata['_toc_parsed'] = ast.literal_eval(toc_items)
+            except Exception:
+                metadata['_toc_parsed'] = None
+        
+        meta_cache[doc_id] = metadata
+    return metadata
@@ -3,28 +3,64 @@ Image extraction and processing for the Chat with Docs application.
 """
 
 import os
+import re
 import json
+import logging
+import functools
+import concurrent.futures
 import streamlit as st
 from .logger import Logger
 from ..config import IMAGES_PATH
 
+# Use orjson's faster decoder for image metadata when it's installed
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
 
-def process_source_for_images(source, current_doc_id, available_images):
+# Matches Markdown image references like ![](/path/to/image.jpg)
+_MD_IMG_RE = re.compile(r"!\[\]\(([^)]+)\)")
+
+# Number of threads used to check image paths; smaller image lists are checked serially
+_VALIDATION_WORKERS = 16
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_images_metadata(images_json):
     """
-    Process a source node for image references using Markdown-style image patterns found in the text.
+    Parse the JSON-encoded images metadata stored on a source node.
+    
+    Results are cached on the raw string, since the same nodes are cited across queries.
+    
+    Args:
+        images_json: JSON string from a node's 'images' metadata
+        
+    Returns:
+        A tuple of image metadata dictionaries
+    """
+    return tuple(_json_loads(images_json or '[]'))
+
+
+def process_source_for_images(source, current_doc_id, image_index):
+    """
+    Process a source node for images listed in its 'images' metadata and for image references
+    using Markdown-style image patterns found in the text.
     The pattern is: ![](/path/to/image.jpg)
     
     Args:
         source: The source node to process
         current_doc_id: The ID of the current document
-        available_images: List of available image paths
+        image_index: Set of available image paths, as returned by get_document_image_index
         
     Returns:
-        A list of image information dictionaries (path, caption)
+        A list of unique image information dictionaries (file_path, caption, page), metadata images first
     """
-    images = []
+    # Images keyed by file path, so repeated references are dropped on insert
+    images_by_path = {}
 
-    Logger.info(f"Source: {source}")
+    if Logger.is_enabled_for(logging.INFO):
+        Logger.info(f"Source: {source}")
 
     
     # Get metadata and text from the source
@@ -32,30 +68,40 @@ def process_source_for_images(source, current_doc_id, available_images):
         metadata = source.metadata
         text = source.text
     else:
-        return images
+        return []
     
     # Get the page number from metadata
     page_num = metadata.get('page')
     
     # Debug current source information
     Logger.info(f"Processing source for images - doc_id: {current_doc_id}, page: {page_num}")
-    Logger.info(f"Available images count: {len(available_images)}")
+    Logger.info(f"Available images count: {len(image_index)}")
     
 
     # DEBUG: Log page number and Markdown image references
     Logger.info(f"Source page: {page_num}")
-    if text:
-        import re
-        image_matches = re.findall(r'!\[\]\(([^)]+)\)', text)
-        Logger.info(f"Found {len(image_matches)} Markdown image references in source text")
-        for img_path in image_matches:
-            Logger.info(f"Markdown image path: {img_path}")
+
+    # Images recorded in the source metadata at indexing time
+    try:
+        for img_meta in parse_images_metadata(metadata.get('images', '')):
+            img_path = img_meta.get('file_path')
+            caption = img_meta.get('caption') or ''
+            if img_path and img_path not in images_by_path:
+                images_by_path[img_path] = {
+                    'file_path': img_path,
+                    'caption': '' if caption.strip() == '-----' else caption,
+                    'page': page_num
+                }
+                Logger.debug(f"Added image from metadata: {img_path}")
+    except Exception as e:
+        Logger.warning(f"Error parsing images metadata: {e}")
 
     # Look for the Markdown image syntax: ![](image_path)
     if text:
-        import re
         # Match pattern ![](image_path)
-        image_matches = re.findall(r'!\[\]\(([^)]+)\)', text)
+        image_matches = _MD_IMG_RE.findall(text)
+        for img_path in image_matches:
+            Logger.info(f"Markdown image path: {img_path}")
         
         if image_matches:
             Logger.info(f"Found {len(image_matches)} Markdown image references in text")
@@ -64,11 +110,9 @@ def process_source_for_images(source, current_doc_id, available_images):
                 # Clean up the path (remove any whitespace)
                 img_path = img_path.strip()
                 
-                # Check if this path exists in available images
-                if img_path in available_images:
+                # Check if this path exists in available images (skipping repeated references)
+                if img_path in image_index and img_path not in images_by_path:
                     # Direct match - use it as is
-                    # Extract actual page number from the image path
-                    import re
                     # Always use the page number from the source metadata, which is the correct context
                     # When the image appears in a source, it should be associated with that source's page
                     page_display = page_num if isinstance(page_num, int) else 1
@@ -76,16 +120,71 @@ def process_source_for_images(source, current_doc_id, available_images):
                     
                     image_info = {
                         'file_path': img_path,  # Use file_path consistently across the application
-                        'caption': f"Image from page {page_display}"
+                        'caption': f"Image from page {page_display}",
+                        'page': page_display
                     }
-                    images.append(image_info)
+                    images_by_path[img_path] = image_info
                     Logger.info(f"Added image from direct Markdown reference: {img_path}")
     
-    return images
+    return list(images_by_path.values())
+
+
+def _check_image_path(img_path):
+    """
+    Check whether an image path exists, preferring its absolute form.
+    
+    Runs in worker threads, so it must not touch session state or log to the UI.
+    
+    Args:
+        img_path: The stored image path
+        
+    Returns:
+        The existing (absolute or original) path, or None if neither exists
+    """
+    try:
+        abs_path = os.path.abspath(img_path)
+        if os.path.exists(abs_path):
+            return abs_path
+        if os.path.exists(img_path):
+            return img_path
+    except Exception:
+        pass
+    return None
+
+
+def _get_image_dir_entries(doc_id, doc_dir):
+    """
+    List the file names in a document's image directory.
+    
+    The listing is cached in session state and reused until the directory's
+    modification time changes.
+    
+    Args:
+        doc_id: The document ID
+        doc_dir: The document's image directory
+        
+    Returns:
+        A list of file names, or None if the directory doesn't exist
+    """
+    try:
+        mtime = os.stat(doc_dir).st_mtime
+    except FileNotFoundError:
+        return None
     
-    # No need for duplicated code - it was removed
+    cache = st.session_state.setdefault('_img_dir_entries', {})
+    cached = cache.get(doc_id)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
     
-    return images
+    Logger.debug(f"Listing images in document directory: {doc_dir}")
+    try:
+        with os.scandir(doc_dir) as it:
+            entries = [e.name for e in it if e.is_file()]
+    except FileNotFoundError:
+        return None
+    
+    cache[doc_id] = (mtime, entries)
+    return entries
 
 
 def get_document_images(doc_id):
@@ -100,60 +199,70 @@ def get_document_images(doc_id):
     """
     if doc_id in st.session_state.get('document_image_map', {}):
         images = st.session_state['document_image_map'][doc_id]
+        
+        # Reuse the validated list while the document's image map is unchanged
+        # (the map's list is replaced whenever the document is reprocessed)
+        cache = st.session_state.setdefault('_valid_images', {})
+        key = (doc_id, id(images))
+        if key in cache and doc_id in st.session_state.get('_img_index', {}):
+            return cache[key]
+        
         Logger.info(f"Found {len(images)} images for document {doc_id} in session state")
         
-        # Verify image paths exist
+        # Verify image paths exist, checking them concurrently for larger documents
+        if len(images) < _VALIDATION_WORKERS:
+            checked_paths = [_check_image_path(img_path) for img_path in images]
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=_VALIDATION_WORKERS) as executor:
+                checked_paths = list(executor.map(_check_image_path, images))
+        
         valid_images = []
         invalid_images = 0
         
-        for img_path in images:
+        # Document image directory, only listed if some image path can't be found directly
+        doc_dir = os.path.join(IMAGES_PATH, doc_id)
+        dir_entries = None
+        dir_listed = False
+        
+        for img_path, checked_path in zip(images, checked_paths):
+            if checked_path:
+                valid_images.append(checked_path)
+                continue
+            
             try:
-                # Convert to absolute path
-                abs_path = os.path.abspath(img_path)
+                # Look in the document directory, listed once and shared by all missing images
+                if not dir_listed:
+                    dir_entries = _get_image_dir_entries(doc_id, doc_dir)
+                    dir_listed = True
                 
-                # Check if the image still exists
-                if os.path.exists(abs_path):
-                    valid_images.append(abs_path)
-                    Logger.debug(f"Verified image exists: {abs_path}")
-                elif os.path.exists(img_path):
-                    valid_images.append(img_path)
-                    Logger.debug(f"Verified image exists (relative path): {img_path}")
-                else:
-                    # Find the correct document directory
-                    doc_dir = os.path.join(IMAGES_PATH, doc_id)
-                    Logger.debug(f"Looking for images in document directory: {doc_dir}")
+                if dir_entries is not None:
+                    # Get just the filename from the path (without directories)
+                    img_filename = os.path.basename(img_path)
                     
-                    if os.path.exists(doc_dir):
-                        # Get images matching the filename pattern
-                        import glob
-                        
-                        # Get just the filename from the path (without directories)
-                        img_filename = os.path.basename(img_path)
-                        
-                        # Look for exact filename match first
+                    # Look for exact filename match first
+                    if img_filename in dir_entries:
                         exact_path = os.path.join(doc_dir, img_filename)
-                        if os.path.exists(exact_path):
-                            valid_images.append(exact_path)
-                            Logger.info(f"Found exact image match: {exact_path}")
-                        else:
-                            # Try to find a file with the same name pattern
-                            # For example, if img_path is "P19-1044.pdf-3-0.jpg" but the actual
-                            # file has a timestamp like "P19-1044_1743486037.pdf-3-0.jpg"
-                            file_name = os.path.basename(img_filename)
-                            pattern = os.path.join(doc_dir, f"*{os.path.splitext(file_name)[0]}*.jpg")
-                            Logger.debug(f"Searching with pattern: {pattern}")
-                            
-                            matching_files = glob.glob(pattern)
-                            if matching_files:
-                                valid_images.append(matching_files[0])
-                                Logger.info(f"Found matching image: {matching_files[0]}")
-                            else:
-                                # No fallback - only use pattern matches
-                                Logger.warning(f"No matching images found for pattern: {pattern}")
-                                invalid_images += 1
+                        valid_images.append(exact_path)
+                        Logger.info(f"Found exact image match: {exact_path}")
                     else:
-                        Logger.warning(f"Document directory not found: {doc_dir}")
-                        invalid_images += 1
+                        # Try to find a file with the same name pattern
+                        # For example, if img_path is "P19-1044.pdf-3-0.jpg" but the actual
+                        # file has a timestamp like "P19-1044_1743486037.pdf-3-0.jpg"
+                        stem = os.path.splitext(img_filename)[0]
+                        match = next(
+                            (os.path.join(doc_dir, n) for n in dir_entries if n.endswith('.jpg') and stem in n),
+                            None
+                        )
+                        if match:
+                            valid_images.append(match)
+                            Logger.info(f"Found matching image: {match}")
+                        else:
+                            # No fallback - only use pattern matches
+                            Logger.warning(f"No matching images found for {img_filename} in {doc_dir}")
+                            invalid_images += 1
+                else:
+                    Logger.warning(f"Document directory not found: {doc_dir}")
+                    invalid_images += 1
             except Exception as e:
                 Logger.error(f"Error processing image path {img_path}: {e}")
                 invalid_images += 1
@@ -162,7 +271,31 @@ def get_document_images(doc_id):
             Logger.warning(f"Could not find {invalid_images} images for document {doc_id}")
         
         Logger.info(f"Returning {len(valid_images)} valid images for document {doc_id}")
+
+        # Cache a set of the valid paths so image references can be checked without scanning the list
+        st.session_state.setdefault('_img_index', {})[doc_id] = set(valid_images)
+        cache[key] = valid_images
         return valid_images
     
     Logger.info(f"No images found for document {doc_id} in session state")
-    return []
\ No newline at end of file
+    return []
+
+
+def get_document_image_index(doc_id):
+    """
+    Get the set of valid image paths associated with a document.
+    
+    The index is built by get_document_images and cached in session state until the
+    document's image map is updated.
+    
+    Args:
+        doc_id: The document ID
+        
+    Returns:
+        A set of image paths
+    """
+    image_index = st.session_state.get('_img_index', {}).get(doc_id)
+    if image_index is None:
+        get_document_images(doc_id)
+        image_index = st.session_state.get('_img_index', {}).get(doc_id, set())
+    return image_index
@@ -63,6 +63,17 @@ class Logger:
                 except Exception as e:
                     cls._logger.error(f"Could not create log file: {str(e)}")
     
+    @classmethod
+    def is_enabled_for(cls, level: int) -> bool:
+        """Check whether messages of the given level would be logged.
+        
+        Args:
+            level: Logging level, e.g. logging.INFO
+        """
+        if cls._logger is None:
+            cls.initialize()
+        return cls._logger.isEnabledFor(level)
+    
     @classmethod
     def debug(cls, message: str):
         """Log a debug message."""